@@ -1,11 +1,19 @@
+import asyncio
+import json
 import logging
-from fastapi import FastAPI, Query, Response
+import threading
+import time
+from io import StringIO
+from fastapi import FastAPI, Query
+from fastapi.responses import FileResponse
 from datetime import datetime, timedelta
 import yfinance as yf
 import pandas as pd
+import numpy as np
 import os
 from apscheduler.schedulers.background import BackgroundScheduler
-import requests
+import requests_cache
+from settings import YF_CACHE_TTL
 
 # Initialize logger
 logging.basicConfig(level=logging.INFO)
@@ -16,61 +24,232 @@ app = FastAPI()
 HISTORY_DIR = "./scan_history"
 os.makedirs(HISTORY_DIR, exist_ok=True)
 
-def get_tickers():
-    """Fetch tickers dynamically for S&P 500, NIFTY 50, and BSE SENSEX."""
-    tickers = []
+# Number of tickers requested per yf.download call
+BATCH_SIZE = 200
+
+# Index constituents change rarely, so the ticker list is reused for a day
+TICKER_CACHE_TTL = 24 * 60 * 60
+TICKER_CACHE_FILE = os.path.join(HISTORY_DIR, "tickers.json")
+_ticker_cache = {"timestamp": 0.0, "tickers": []}
+_ticker_cache_lock = threading.Lock()
+
+# HTTP cache for the Wikipedia pages the ticker lists are parsed from
+wiki_session = requests_cache.CachedSession("wikipedia_cache", expire_after=TICKER_CACHE_TTL)
+
+# Downloaded Adj Close series per ticker, reused by repeat scans within YF_CACHE_TTL
+_price_cache = {}
+_price_cache_lock = threading.Lock()
 
+def read_wiki_tables(url):
+    """Fetch a Wikipedia page through the HTTP cache and parse its tables."""
+    response = wiki_session.get(url, headers={"User-Agent": "stock-scanner"})
+    response.raise_for_status()
+    return pd.read_html(StringIO(response.text))
+
+def load_ticker_cache():
+    """Load the ticker list persisted by a previous run, if any."""
+    try:
+        with open(TICKER_CACHE_FILE) as f:
+            cached = json.load(f)
+        return {"timestamp": float(cached["timestamp"]), "tickers": list(cached["tickers"])}
+    except (OSError, ValueError, KeyError, TypeError):
+        return {"timestamp": 0.0, "tickers": []}
+
+def save_ticker_cache(cache):
+    """Persist the ticker list so a restarted server can reuse it."""
     try:
-        # Fetch S&P 500 tickers
-        sp500_url = "https://en.wikipedia.org/wiki/List_of_S%26P_500_companies"
-        sp500_table = pd.read_html(sp500_url)[0]
-        sp500_tickers = sp500_table["Symbol"].tolist()
-        tickers.extend(sp500_tickers)
-        logging.info(f"Fetched {len(sp500_tickers)} S&P 500 tickers.")
-
-        # Fetching NIFTY 50 tickers (use "Symbol" instead of "Company Name")
-        nifty50_url = "https://en.wikipedia.org/wiki/NIFTY_50"
-        nifty50_table = pd.read_html(nifty50_url)[1]
-        logging.info(f"NIFTY 50 Table Columns: {nifty50_table.columns}")
-        nifty50_tickers = nifty50_table["Symbol"].tolist()
-        tickers.extend([f"{ticker}.NS" for ticker in nifty50_tickers])
-        logging.info(f"Fetched {len(nifty50_tickers)} NIFTY 50 tickers.")
-
-        # Fetching BSE SENSEX tickers from Wikipedia
-        sensex_url = "https://en.wikipedia.org/wiki/List_of_BSE_SENSEX_companies"
-        sensex_table = pd.read_html(sensex_url)[0]
-        logging.info(f"SENSEX Table Columns: {sensex_table.columns}")
-
-        # Extract symbols and ensure ".BO" is added only if missing
-        sensex_tickers = [
-            f"{ticker}.BO" if not ticker.endswith(".BO") else ticker
-            for ticker in sensex_table["Symbol"].tolist()
-        ]
-        tickers.extend(sensex_tickers)
-        logging.info(f"Fetched {len(sensex_tickers)} BSE SENSEX tickers.")
+        with open(TICKER_CACHE_FILE, "w") as f:
+            json.dump(cache, f)
+    except OSError as e:
+        logging.warning(f"Failed to save ticker cache: {str(e)}")
+
+def get_tickers():
+    """Return the index tickers, refreshing them from Wikipedia once the cache expires."""
+    global _ticker_cache
 
+    with _ticker_cache_lock:
+        if not _ticker_cache["tickers"]:
+            _ticker_cache = load_ticker_cache()
+
+        if _ticker_cache["tickers"] and time.time() - _ticker_cache["timestamp"] < TICKER_CACHE_TTL:
+            logging.info(f"Using {len(_ticker_cache['tickers'])} cached tickers.")
+            return list(_ticker_cache["tickers"])
+
+        tickers, complete = fetch_tickers()
+        if complete:
+            _ticker_cache = {"timestamp": time.time(), "tickers": tickers}
+            save_ticker_cache(_ticker_cache)
+            return list(tickers)
+
+        # Never cache a partial list; prefer the last complete one if there is one
+        if _ticker_cache["tickers"]:
+            logging.warning("Falling back to expired ticker cache.")
+            return list(_ticker_cache["tickers"])
+        logging.warning(f"Scanning the {len(tickers)} tickers that could be fetched.")
         return tickers
-    
-    except Exception as e:
-        logging.error(f"Failed to fetch tickers: {str(e)}")
 
-    return tickers
+def fetch_sp500_tickers():
+    """Fetch S&P 500 tickers."""
+    sp500_url = "https://en.wikipedia.org/wiki/List_of_S%26P_500_companies"
+    sp500_table = read_wiki_tables(sp500_url)[0]
+    return sp500_table["Symbol"].tolist()
+
+def fetch_nifty50_tickers():
+    """Fetch NIFTY 50 tickers (use "Symbol" instead of "Company Name")."""
+    nifty50_url = "https://en.wikipedia.org/wiki/NIFTY_50"
+    nifty50_table = read_wiki_tables(nifty50_url)[1]
+    logging.info(f"NIFTY 50 Table Columns: {nifty50_table.columns}")
+    return [f"{ticker}.NS" for ticker in nifty50_table["Symbol"].tolist()]
+
+def fetch_sensex_tickers():
+    """Fetch BSE SENSEX tickers from Wikipedia."""
+    sensex_url = "https://en.wikipedia.org/wiki/List_of_BSE_SENSEX_companies"
+    sensex_table = read_wiki_tables(sensex_url)[0]
+    logging.info(f"SENSEX Table Columns: {sensex_table.columns}")
+
+    # Extract symbols and ensure ".BO" is added only if missing
+    return [
+        f"{ticker}.BO" if not ticker.endswith(".BO") else ticker
+        for ticker in sensex_table["Symbol"].tolist()
+    ]
+
+def fetch_tickers():
+    """Fetch tickers dynamically for S&P 500, NIFTY 50, and BSE SENSEX.
+
+    Returns the tickers that were fetched and whether every index succeeded.
+    """
+    tickers = []
+    complete = True
+
+    for index_name, fetch_index in (
+        ("S&P 500", fetch_sp500_tickers),
+        ("NIFTY 50", fetch_nifty50_tickers),
+        ("BSE SENSEX", fetch_sensex_tickers),
+    ):
+        try:
+            index_tickers = fetch_index()
+        except Exception as e:
+            logging.error(f"Failed to fetch {index_name} tickers: {str(e)}")
+            complete = False
+            continue
+        tickers.extend(index_tickers)
+        logging.info(f"Fetched {len(index_tickers)} {index_name} tickers.")
+
+    return tickers, complete
+
+# Saved scan formats and the media type each is served with
+HISTORY_MEDIA_TYPES = {
+    ".parquet": "application/octet-stream",
+    ".csv": "text/csv",
+}
 
-def get_file_name():
+def get_file_name(extension=".parquet"):
     """Generate filename with the current date and day."""
     now = datetime.now()
-    return f"{now.strftime('%Y-%m-%d_%A')}.csv"
+    return f"{now.strftime('%Y-%m-%d_%A')}{extension}"
 
-def save_scan_results(df):
-    """Save the scan results to a CSV file."""
-    file_name = get_file_name()
-    file_path = os.path.join(HISTORY_DIR, file_name)
-    df.to_csv(file_path, index=False)
+def save_scan_results(df, csv=False):
+    """Save the scan results to a Parquet file, plus a CSV copy if requested."""
+    file_path = os.path.join(HISTORY_DIR, get_file_name(".parquet"))
+    df.to_parquet(file_path, engine="pyarrow", compression="snappy", index=False)
     logging.info(f"Results saved to {file_path}")
 
+    if csv:
+        csv_path = os.path.join(HISTORY_DIR, get_file_name(".csv"))
+        df.to_csv(csv_path, index=False)
+        logging.info(f"Results saved to {csv_path}")
+
+# Saved scan files, keyed by the history directory's mtime
+_history_cache = {"mtime_ns": None, "files": []}
+
 def get_scan_history():
-    """Get the list of saved scan files."""
-    return [f for f in os.listdir(HISTORY_DIR) if f.endswith(".csv")]
+    """Get the list of saved scan files, re-reading the directory only after it changes."""
+    global _history_cache
+
+    mtime_ns = os.stat(HISTORY_DIR).st_mtime_ns
+    if _history_cache["mtime_ns"] != mtime_ns:
+        with os.scandir(HISTORY_DIR) as entries:
+            files = [
+                entry.name for entry in entries
+                if entry.name.endswith(tuple(HISTORY_MEDIA_TYPES)) and entry.is_file()
+            ]
+        _history_cache = {"mtime_ns": mtime_ns, "files": files}
+    return list(_history_cache["files"])
+
+def download_prices(tickers, start_date, end_date):
+    """Download adjusted closes for all tickers in batched, threaded requests, one column per ticker."""
+    frames = []
+    for i in range(0, len(tickers), BATCH_SIZE):
+        batch = tickers[i:i + BATCH_SIZE]
+        logging.info(f"Fetching data for tickers {i + 1}-{i + len(batch)} of {len(tickers)}")
+        data = yf.download(
+            batch,
+            start=start_date,
+            end=end_date,
+            group_by="ticker",
+            threads=min(32, len(batch)),
+            auto_adjust=False,
+            progress=False,
+        )
+        # Single-ticker batches may come back without the ticker column level
+        if not isinstance(data.columns, pd.MultiIndex):
+            data.columns = pd.MultiIndex.from_product([batch, data.columns])
+        if "Adj Close" not in data.columns.get_level_values(1):
+            logging.warning(f"No 'Adj Close' data returned for tickers {i + 1}-{i + len(batch)}.")
+            continue
+        # Only the adjusted close is used, so keep just that column in single precision
+        frames.append(data.xs("Adj Close", axis=1, level=1).astype("float32"))
+
+    if not frames:
+        return pd.DataFrame(dtype="float32")
+    return pd.concat(frames, axis=1)
+
+def get_prices(tickers, start_date, end_date):
+    """Return adjusted closes for the tickers, downloading only those not fetched in the last hour."""
+    dates = (start_date.date(), end_date.date())
+    tickers = list(dict.fromkeys(tickers))
+    with _price_cache_lock:
+        now = time.time()
+        for expired in [k for k, (ts, _) in _price_cache.items() if now - ts >= YF_CACHE_TTL]:
+            del _price_cache[expired]
+        prices = {t: _price_cache[(t, *dates)][1] for t in tickers if (t, *dates) in _price_cache}
+
+    missing = [t for t in tickers if t not in prices]
+    if prices:
+        logging.info(f"Using cached price data for {len(prices)} tickers.")
+    if missing:
+        adj_close = download_prices(missing, start_date, end_date)
+        adj_close = adj_close.loc[:, ~adj_close.columns.duplicated()]
+        fetched_at = time.time()
+        with _price_cache_lock:
+            # Only tickers that returned prices are cached, so failed ones are retried next scan
+            for ticker in adj_close.columns[adj_close.notna().any().to_numpy()]:
+                prices[ticker] = adj_close[ticker]
+                _price_cache[(ticker, *dates)] = (fetched_at, prices[ticker])
+
+    columns = [prices[t] for t in tickers if t in prices]
+    if not columns:
+        return pd.DataFrame(dtype="float32")
+    return pd.concat(columns, axis=1)
+
+def compute_returns(adj_close):
+    """Compute each ticker's percent return between its first and last valid price."""
+    values = adj_close.to_numpy(dtype=float)
+    valid = ~np.isnan(values)
+    returns = np.full(values.shape[1], np.nan)
+
+    # Only tickers with at least two prices have a meaningful return
+    has_range = valid.sum(axis=0) >= 2
+    if has_range.any():
+        values, valid = values[:, has_range], valid[:, has_range]
+        columns = np.arange(values.shape[1])
+        first_idx = valid.argmax(axis=0)
+        last_idx = len(values) - 1 - valid[::-1].argmax(axis=0)
+        start_prices = values[first_idx, columns]
+        end_prices = values[last_idx, columns]
+        returns[has_range] = (end_prices - start_prices) / start_prices * 100
+
+    return pd.Series(returns, index=adj_close.columns)
 
 @app.get("/")
 def read_root():
@@ -84,45 +263,29 @@ def read_root():
 @app.get("/scan")
 async def scan_stocks(
     min_return: float = Query(0.0, description="Minimum return over the period (e.g., 0.0 for 0%)"),
-    years: int = Query(7, description="Number of years for the scan")
+    years: int = Query(7, description="Number of years for the scan"),
+    csv: bool = Query(False, description="Also save the results as CSV for legacy consumers")
 ):
     """Perform a stock scan and save the results."""
     try:
-        tickers = get_tickers()
+        # Ticker lookup and price download block on network I/O, so keep them off the event loop
+        tickers = await asyncio.to_thread(get_tickers)
         today = datetime.today()
         start_date = today - timedelta(days=years * 365)
 
         logging.info(f"Scanning stocks from {start_date.date()} to {today.date()}")
-        results = []
-
-        for ticker in tickers:
-            logging.info(f"Fetching data for: {ticker}")
-            data = yf.download(ticker, start=start_date, end=today, progress=False)
-
-            if isinstance(data.columns, pd.MultiIndex):
-                data.columns = ['_'.join(col).strip() for col in data.columns]
-
-            adj_close_column = f"Adj Close_{ticker}" if f"Adj Close_{ticker}" in data.columns else "Adj Close"
-            if adj_close_column not in data.columns:
-                logging.warning(f"No valid '{adj_close_column}' data for {ticker}. Skipping...")
-                continue
-
-            data = data.dropna(subset=[adj_close_column])
-            if len(data) < 2:
-                logging.warning(f"Not enough data points for {ticker}. Skipping...")
-                continue
-
-            start_price = data[adj_close_column].iloc[0]
-            end_price = data[adj_close_column].iloc[-1]
-            percent_return = ((end_price - start_price) / start_price) * 100
+        adj_close = await asyncio.to_thread(get_prices, tickers, start_date, today)
+        returns = compute_returns(adj_close)
 
-            logging.info(f"{ticker}: Start Price = {start_price}, End Price = {end_price}, Return = {percent_return}%")
-            if percent_return <= min_return:
-                results.append({"Ticker": ticker, "Return": round(percent_return, 2)})
+        missing = returns.index[returns.isna()].tolist()
+        missing += [ticker for ticker in tickers if ticker not in returns.index]
+        if missing:
+            logging.warning(f"Not enough data points for {len(missing)} tickers. Skipping: {missing}")
 
-        df = pd.DataFrame(results)
+        matches = returns[returns <= min_return]
+        df = pd.DataFrame({"Ticker": matches.index, "Return": matches.round(2).to_numpy()})
         logging.info(f"Total matching stocks: {len(df)}")
-        save_scan_results(df)
+        save_scan_results(df, csv=csv)
         return {"status": "success", "data": df.to_dict(orient="records")}
 
     except Exception as e:
@@ -130,22 +293,23 @@ async def scan_stocks(
         return {"status": "error", "message": str(e)}
 
 @app.get("/download/{file_name}")
-def download_file(file_name: str, response: Response):
+def download_file(file_name: str):
     """Download a specific scan result file."""
     file_path = os.path.join(HISTORY_DIR, file_name)
     if not os.path.exists(file_path):
         return {"status": "error", "message": "File not found."}
 
-    response.headers["Content-Disposition"] = f"attachment; filename={file_name}"
-    with open(file_path, "rb") as f:
-        return Response(f.read(), media_type="text/csv")
+    media_type = HISTORY_MEDIA_TYPES.get(os.path.splitext(file_name)[1], "application/octet-stream")
+    # Streamed from disk (sendfile where available) rather than read into memory
+    return FileResponse(file_path, media_type=media_type, filename=file_name)
 
 def run_daily_scan():
     """Function to run the scan automatically at a scheduled time."""
     logging.info("Running daily scan...")
     try:
-        response = requests.get("http://127.0.0.1:8000/scan?min_return=0&years=7")
-        logging.info(f"Daily scan completed with status: {response.status_code}")
+        # Call the endpoint in-process; every argument is passed since the defaults are Query objects
+        result = asyncio.run(scan_stocks(min_return=0.0, years=7, csv=False))
+        logging.info(f"Daily scan completed with status: {result['status']}")
     except Exception as e:
         logging.error(f"Failed to run daily scan: {str(e)}")
 
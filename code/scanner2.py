@@ -1,8 +1,10 @@
 import yfinance as yf
 import pandas as pd
+from pandas.api.indexers import FixedForwardWindowIndexer
 import numpy as np
 import streamlit as st
 import matplotlib.pyplot as plt
+from settings import YF_CACHE_TTL
 
 # Streamlit App Header
 st.title("Lifetime High Stock Scanner")
@@ -21,54 +23,97 @@ threshold = st.slider(
 )
 analyze_button = st.button("Analyze Stocks")
 
-def fetch_stock_data(ticker, period="10y", interval="1d"):
-    """Fetch historical stock data using yfinance."""
-    try:
-        stock = yf.Ticker(ticker)
-        data = stock.history(period=period, interval=interval)
+# Price columns downcast to float32 after download
+PRICE_COLUMNS = ("Open", "High", "Low", "Close", "Adj Close")
+
+def fetch_stock_data(tickers, period="10y", interval="1d"):
+    """Fetch historical stock data for all tickers, reusing downloads from the last hour."""
+    tickers = list(dict.fromkeys(tickers))
+    stock_data = download_stock_data(tickers, period, interval)
+    # yfinance reports failed tickers as missing data rather than raising, so never
+    # keep a result that lacks any ticker; the next click retries the download
+    if any(ticker not in stock_data for ticker in tickers):
+        download_stock_data.clear()
+    return stock_data
+
+@st.cache_data(ttl=YF_CACHE_TTL, show_spinner=False)
+def download_stock_data(tickers, period, interval):
+    """Download historical stock data for all tickers in one yfinance call, keyed by ticker."""
+    bulk = yf.download(
+        tickers,
+        period=period,
+        interval=interval,
+        group_by="ticker",
+        threads=True,
+        auto_adjust=True,  # Match the adjusted prices Ticker.history returns
+        progress=False,
+    )
+    # A single ticker may come back without the ticker column level
+    if not isinstance(bulk.columns, pd.MultiIndex):
+        bulk.columns = pd.MultiIndex.from_product([tickers, bulk.columns])
+
+    stock_data = {}
+    downloaded = set(bulk.columns.get_level_values(0))
+    for ticker in tickers:
+        if ticker not in downloaded:
+            continue
+        # Rows are aligned across all tickers, so drop the dates this one didn't trade
+        data = bulk[ticker].dropna(subset=["Close"])
         if data.empty:
-            st.warning(f"No data found for {ticker}. Skipping.")
-            return None
-        data.reset_index(inplace=True)  # Ensure 'Date' is a column, not an index
-        return data
-    except Exception as e:
-        st.error(f"Error fetching data for {ticker}: {e}")
-        return None
+            continue
+        # Single precision is plenty for prices and halves the memory each scan touches
+        data = data.astype({column: "float32" for column in PRICE_COLUMNS if column in data.columns})
+        if "Volume" in data.columns:
+            data["Volume"] = pd.to_numeric(data["Volume"], downcast="unsigned")
+        stock_data[ticker] = data.reset_index()  # Ensure 'Date' is a column, not an index
+    return stock_data
 
 def detect_lifetime_highs(data):
     """Detect lifetime highs from the stock data."""
-    data['Lifetime_High'] = data['Close'].cummax()
-    data['Is_High'] = np.where(data['Close'] == data['Lifetime_High'], 1, 0)
+    close = data['Close'].to_numpy()
+    lifetime_high = np.fmax.accumulate(close)  # fmax skips NaN closes like cummax
+    data['Lifetime_High'] = lifetime_high
+    data['Is_High'] = (close == lifetime_high).view(np.int8)
     return data
 
 def find_support_and_appreciation(data, threshold=0.10):
     """Identify instances where lifetime high acted as support with appreciation."""
-    opportunities = []
-    for i in range(1, len(data)):
-        if data['Is_High'].iloc[i - 1] == 1:  # Found a lifetime high
-            support_region = data['Low'].iloc[i:i + 10].min()  # Look ahead 10 days
-            if support_region >= data['Lifetime_High'].iloc[i - 1] * 0.98:  # Holds support
-                future_price = data['Close'].iloc[i + 10:i + 30].max()  # Next 20 days
-                appreciation = (future_price - data['Lifetime_High'].iloc[i - 1]) / data['Lifetime_High'].iloc[i - 1]
-                
-                if appreciation >= threshold:  # Appreciates by threshold
-                    opportunities.append({
-                        "Date": data['Date'].iloc[i],  # Ensure 'Date' is accessed correctly
-                        "Lifetime_High": data['Lifetime_High'].iloc[i - 1],
-                        "Appreciation": round(appreciation * 100, 2)
-                    })
-    return pd.DataFrame(opportunities)
+    # Lowest low over the next 10 days and highest close over the 20 days after that
+    support_low = data['Low'].rolling(FixedForwardWindowIndexer(window_size=10), min_periods=1).min()
+    future_high = data['Close'].shift(-10).rolling(FixedForwardWindowIndexer(window_size=20), min_periods=1).max()
+
+    prev_high = data['Lifetime_High'].shift(1)
+    appreciation = (future_high - prev_high) / prev_high
+    mask = (
+        (data['Is_High'].shift(1) == 1)  # Found a lifetime high
+        & (support_low >= prev_high * 0.98)  # Holds support
+        & (appreciation >= threshold)  # Appreciates by threshold
+    )
+    return pd.DataFrame({
+        "Date": data['Date'][mask].to_numpy(),
+        "Lifetime_High": prev_high[mask].to_numpy(),
+        "Appreciation": (appreciation[mask] * 100).round(2).to_numpy()
+    })
 
 def analyze_stocks(tickers, threshold=0.10):
     """Analyze multiple stocks and find opportunities."""
+    st.write(f"Fetching data for {len(tickers)} tickers...")
+    try:
+        stock_data = fetch_stock_data(tickers)
+    except Exception as e:
+        st.error(f"Error fetching stock data: {e}")
+        return []
+
     results = []
     for ticker in tickers:
+        data = stock_data.get(ticker)
+        if data is None:
+            st.warning(f"No data found for {ticker}. Skipping.")
+            continue
         st.write(f"Analyzing {ticker}...")
-        data = fetch_stock_data(ticker)
-        if data is not None:
-            data = detect_lifetime_highs(data)
-            opportunities = find_support_and_appreciation(data, threshold / 100)
-            results.append((ticker, opportunities))
+        data = detect_lifetime_highs(data)
+        opportunities = find_support_and_appreciation(data, threshold / 100)
+        results.append((ticker, opportunities))
     return results
 
 def provide_analysis_summary(ticker, opportunities):
@@ -91,7 +136,7 @@ def display_results(results):
     total_instances = 0
     successful_instances = 0
 
-    all_opportunities = pd.DataFrame()  # Initialize an empty DataFrame
+    chunks = []  # Per-ticker opportunities, concatenated once after the loop
 
     for ticker, opportunities in results:
         if opportunities.empty:
@@ -105,11 +150,13 @@ def display_results(results):
         successful_instances += len(opportunities[opportunities['Appreciation'] >= threshold])
 
         # Accumulate all opportunities for further analysis
-        all_opportunities = pd.concat([all_opportunities, opportunities], ignore_index=True)
+        chunks.append(opportunities)
 
         # Provide detailed analysis for each stock
         provide_analysis_summary(ticker, opportunities)
 
+    all_opportunities = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame()
+
     if total_instances == 0:
         st.error("No opportunities found for the provided tickers and threshold.")
         return
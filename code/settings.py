@@ -0,0 +1,4 @@
+# Settings shared by the FastAPI and Streamlit scanners
+
+# Seconds a yfinance price download is reused before it is fetched again
+YF_CACHE_TTL = 60 * 60